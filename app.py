@@ -1,18 +1,21 @@
-import pandas as pd
+import streamlit as st
 import os
 import tempfile
+import shutil
+import atexit
 import uuid
 import google.generativeai as genai
 import time
 import logging
-from utils import QuartrAPI, AWSS3StorageHandler, TranscriptProcessor
+from utils import QuartrAPI, AWSS3StorageHandler, TranscriptProcessor, json_dumps, download_s3_object
 import aiohttp
 import asyncio
-from typing import List, Dict, Tuple, Any, Optional
+from typing import List, Dict, Tuple, Any, Optional, Callable, Union
+from collections import OrderedDict, deque
 import json
 import anthropic
 import requests
-from supabase_client import get_company_names, get_isin_by_name, get_quartrid_by_name, get_all_companies
+from supabase_client import get_company_names, get_company_identifiers, get_quartrid_by_name
 import io
 import re
 import threading
@@ -22,13 +25,13 @@ try:
     import fitz  # PyMuPDF
 except ImportError:
     # Log warning instead of failing
+    fitz = None
     print("Warning: PyMuPDF (fitz) not installed. PDF generation functionality may be limited.")
 from anthropic import Anthropic
-from utils_helper import process_company_documents, initialize_claude
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from logging_config import setup_logging
 from logger import logger  # Import the configured logger
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -42,8 +45,12 @@ st.set_page_config(
 )
 
 # Initialize session state variables
+# Maximum number of chat messages kept on screen per session
+MAX_CHAT_MESSAGES = 100
+
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    # (role, content) tuples, oldest dropped first
+    st.session_state.chat_history = deque(maxlen=MAX_CHAT_MESSAGES)
 if "file_uploads" not in st.session_state:
     st.session_state.file_uploads = []
 if "processed_files" not in st.session_state:
@@ -54,8 +61,13 @@ if "company_data" not in st.session_state:
     st.session_state.company_data = None
 if "documents_fetched" not in st.session_state:
     st.session_state.documents_fetched = False
+if "docs_by_company" not in st.session_state:
+    # Processed files per Quartr ID, most recently used last
+    st.session_state.docs_by_company = OrderedDict()
 if "conversation_context" not in st.session_state:
     st.session_state.conversation_context = []
+if "gemini_file_names" not in st.session_state:
+    st.session_state.gemini_file_names = {}
 
 # Load credentials from Streamlit secrets - using flat structure
 try:
@@ -75,17 +87,28 @@ except KeyError as e:
     PERPLEXITY_API_KEY = os.environ.get("PERPLEXITY_API_KEY", "")
     CLAUDE_API_KEY = os.environ.get("CLAUDE_API_KEY", "")
 
-# Load company data from Supabase
-@st.cache_data(ttl=60*60)  # Cache for 1 hour
-def load_company_data():
-    """Load company data from Supabase"""
-    companies = get_all_companies()
-    if not companies:
-        st.error("Failed to load company data from Supabase.")
-        return None
-    return pd.DataFrame(companies)
+# Build the company name list and name -> identifiers map once instead of on every rerun.
+# cache_resource hands every rerun the same read-only object instead of unpickling a fresh copy
+@st.cache_resource(ttl=60*60, show_spinner=False)  # Cache for 1 hour
+def get_company_lookup() -> Tuple[List[str], Dict[str, Dict[str, Optional[str]]]]:
+    """Return company names and a dict mapping each name to its ISIN and Quartr ID
+    
+    Raises if Supabase returned no companies, so a failed load isn't cached for the hour.
+    """
+    names = get_company_names()
+    if not names:
+        raise RuntimeError("No companies loaded from Supabase")
+    lookup = {
+        company["Name"]: {
+            'isin': company.get("ISIN"),
+            'quartr_id': str(company["Quartr Id"]) if company.get("Quartr Id") is not None else None
+        }
+        for company in get_company_identifiers() if "Name" in company
+    }
+    return names, lookup
 
-# Initialize Gemini model
+# Initialize Gemini model (configured once per process)
+@st.cache_resource(show_spinner=False)
 def initialize_gemini():
     if not GEMINI_API_KEY:
         st.error("Gemini API key not found in Streamlit secrets")
@@ -99,6 +122,68 @@ def initialize_gemini():
         st.error(f"Error initializing Gemini: {str(e)}")
         return None
 
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_CACHE_MODEL = "models/gemini-2.0-flash-001"  # Context caching needs a pinned model version
+GEMINI_CACHE_TTL = timedelta(hours=1)
+GEMINI_SYSTEM_INSTRUCTION = "You are a senior financial analyst. Review the attached documents and provide a detailed and structured answer to the user's query."
+GEMINI_GENERATION_CONFIG = genai.types.GenerationConfig(
+    temperature=0.1,
+    max_output_tokens=7000
+)
+
+# Create the Gemini model once per process and reuse it for every query
+@st.cache_resource(show_spinner=False)
+def get_gemini_model():
+    if not initialize_gemini():
+        return None
+    
+    return genai.GenerativeModel(
+        GEMINI_MODEL,
+        system_instruction=GEMINI_SYSTEM_INSTRUCTION,
+        generation_config=GEMINI_GENERATION_CONFIG
+    )
+
+# Keep server-side cached contexts per document set for the lifetime of the process
+@st.cache_resource(show_spinner=False)
+def _gemini_context_cache() -> Dict[Tuple[str, ...], Any]:
+    """Return the process-wide Gemini file names to CachedContent map"""
+    return {}
+
+# Function to get a model whose context already holds the documents
+def get_gemini_model_for_files(gemini_files: List[Any]) -> Tuple[Any, List[Any]]:
+    """Return (model, files still to send), using a cached context for the file set when possible"""
+    model = get_gemini_model()
+    if not model or not gemini_files:
+        return model, list(gemini_files)
+    
+    cache = _gemini_context_cache()
+    key = tuple(sorted(f.name for f in gemini_files))
+    cached_content = cache.get(key)
+    
+    if key not in cache or (cached_content and cached_content.expire_time <= datetime.now(timezone.utc)):
+        try:
+            cached_content = genai.caching.CachedContent.create(
+                model=GEMINI_CACHE_MODEL,
+                system_instruction=GEMINI_SYSTEM_INSTRUCTION,
+                contents=list(gemini_files),
+                ttl=GEMINI_CACHE_TTL
+            )
+            logger.info(f"Gemini API: Cached context {cached_content.name} for {len(gemini_files)} documents")
+        except Exception as e:
+            logger.info(f"Gemini API: Sending documents without a cached context: {str(e)}")
+            # Small document sets fall below the minimum cacheable size, so don't retry them;
+            # other failures (rate limits, 5xx, network) are retried on the next query
+            message = str(e).lower()
+            if 'too small' in message or 'min_total_token_count' in message:
+                cache[key] = None
+            return model, list(gemini_files)
+        cache[key] = cached_content
+    
+    if not cached_content:
+        return model, list(gemini_files)
+    
+    return genai.GenerativeModel.from_cached_content(cached_content, generation_config=GEMINI_GENERATION_CONFIG), []
+
 # Initialize Claude client
 def initialize_claude():
     if not CLAUDE_API_KEY:
@@ -224,7 +309,7 @@ async def query_perplexity(query: str, company_name: str, conversation_context=N
         
         # Use aiohttp to make the request asynchronously
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with aiohttp.ClientSession(timeout=timeout, json_serialize=json_dumps) as session:
                 logger.info("Perplexity API: Sending request to API server")
                 async with session.post(url, json=payload, headers=headers) as response:
                     if response.status != 200:
@@ -286,27 +371,22 @@ async def query_perplexity(query: str, company_name: str, conversation_context=N
         logger.error(f"Error calling Perplexity API: {str(e)}")
         return f"Error calling Perplexity API: {str(e)}", []
 
-# Function to call Claude with combined outputs
-def query_claude(query: str, company_name: str, gemini_output: str, perplexity_output: str, conversation_context=None) -> str:
-    """Call Claude API with combined Gemini and Perplexity outputs for final synthesis"""
-    logger.info("Claude API: Starting synthesis process")
-    start_time = time.time()
-    
-    client = initialize_claude()
-    if not client:
-        return "Error initializing Claude client"
+CLAUDE_MODEL = "claude-3-7-sonnet-20250219"
+CLAUDE_SYSTEM_PROMPT = "You are a senior financial analyst providing detailed analysis for professional investors."
+
+# Build the Claude synthesis prompt from the Gemini and Perplexity outputs
+def build_claude_prompt(query: str, company_name: str, gemini_output: str, perplexity_output: str, conversation_context=None) -> str:
+    """Build the final synthesis prompt, including previous conversation context if any"""
+    # Build conversation history for context (safely)
+    conversation_history = ""
+    if conversation_context:
+        conversation_history = "\n\nPREVIOUS CONVERSATION CONTEXT:\n"
+        for entry in conversation_context:
+            conversation_history += f"Question: {entry['query']}\n"
+            conversation_history += f"Answer: {entry['summary']}\n\n"
     
-    try:
-        # Build conversation history for context (safely)
-        conversation_history = ""
-        if conversation_context:
-            conversation_history = "\n\nPREVIOUS CONVERSATION CONTEXT:\n"
-            for entry in conversation_context:
-                conversation_history += f"Question: {entry['query']}\n"
-                conversation_history += f"Answer: {entry['summary']}\n\n"
-        
-        # Create prompt for Claude
-        prompt = f"""You are a senior financial analyst on listed equities. Here is a question on {company_name}: {query}. 
+    # Create prompt for Claude
+    return f"""You are a senior financial analyst on listed equities. Here is a question on {company_name}: {query}. 
 Give a comprehensive and detailed response using ONLY the context provided below. Do not use your general knowledge or the Internet. 
 If you encounter conflicting information between sources, prioritize the most recent source unless there's a specific reason not to (e.g., if the newer source explicitly references and validates the older information).
 If the most recent available data is more than 6 months old, explicitly mention this in your response and caution that more recent developments may not be reflected in your analysis.
@@ -332,266 +412,641 @@ GEMINI OUTPUT (Based on company documents):
 PERPLEXITY OUTPUT (Based on web search):
 {perplexity_output}
 """
+
+# Function to stream Claude's synthesis so the answer renders as it is generated
+def stream_claude(query: str, company_name: str, gemini_output: str, perplexity_output: str, conversation_context=None):
+    """Yield Claude API synthesis text chunks as they arrive"""
+    logger.info("Claude API: Starting streamed synthesis process")
+    start_time = time.time()
+    
+    client = initialize_claude()
+    if not client:
+        yield "Error initializing Claude client"
+        return
+    
+    try:
+        prompt = build_claude_prompt(query, company_name, gemini_output, perplexity_output, conversation_context)
+        logger.info(f"Claude API: Streaming request with prompt length {len(prompt)} characters")
         
-        logger.info(f"Claude API: Sending request with prompt length {len(prompt)} characters")
-        api_start_time = time.time()
-        
-        # Call Claude API with the updated model name
-        message = client.messages.create(
-            model="claude-3-7-sonnet-20250219",
+        with client.messages.stream(
+            model=CLAUDE_MODEL,
             max_tokens=4000,
             temperature=0.2,
-            system="You are a senior financial analyst providing detailed analysis for professional investors.",
+            system=CLAUDE_SYSTEM_PROMPT,
             messages=[
                 {"role": "user", "content": prompt}
             ]
-        )
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
         
-        api_time = time.time() - api_start_time
-        logger.info(f"Claude API: Received response in {api_time:.2f} seconds")
-        
-        response_text = message.content[0].text
         total_time = time.time() - start_time
-        logger.info(f"Claude API: Total processing time: {total_time:.2f} seconds")
-        
-        return response_text
+        logger.info(f"Claude API: Total streaming time: {total_time:.2f} seconds")
         
     except Exception as e:
-        logger.error(f"Error calling Claude API: {str(e)}")
-        return f"Error calling Claude API: {str(e)}"
+        logger.error(f"Error streaming Claude API response: {str(e)}")
+        yield f"Error calling Claude API: {str(e)}"
+
+# Archive fetched documents in S3; Gemini holds its own copy, so this is off the query path
+ENABLE_S3_ARCHIVAL = os.environ.get("ENABLE_S3_ARCHIVAL", "true").lower() not in ("0", "false", "no")
+
+# Run S3 archival uploads and document prefetches on a long-lived background loop so they never block a rerun
+@st.cache_resource(show_spinner=False)
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="background-loop", daemon=True).start()
+    return loop
+
+# Function to archive a document in S3 without waiting for the upload
+def archive_in_background(storage_handler: AWSS3StorageHandler, data: bytes, filename: str,
+                          content_type: str, on_success: Optional[Callable[[], None]] = None) -> None:
+    """Schedule the S3 upload on the archival loop and log its outcome"""
+    future = asyncio.run_coroutine_threadsafe(
+        storage_handler.upload_file(data, filename, content_type), get_background_loop()
+    )
+    
+    def done(f: concurrent.futures.Future):
+        error = f.exception()
+        if error or not f.result():
+            logger.error(f"Failed to archive {filename} in S3: {error or 'upload returned no success'}")
+        elif on_success:
+            on_success()
+    
+    future.add_done_callback(done)
+
+# Remember ETags of documents already archived in S3, per source URL
+@st.cache_resource(show_spinner=False)
+def _etag_cache() -> Dict[str, Tuple[str, Dict]]:
+    """Return the process-wide source URL to (ETag, file information) cache"""
+    return {}
+
+# Function to download a slides/report PDF and archive it in S3
+async def fetch_and_upload_document(session: aiohttp.ClientSession, storage_handler: AWSS3StorageHandler, doc_url: str,
+                                    doc_type: str, company_name: str, event_date: str, event_title: str) -> Optional[Dict]:
+    """Download a document from Quartr, upload it to Gemini (archiving it in S3) and return its file information"""
+    etag_cache = _etag_cache()
+    cached = etag_cache.get(doc_url) if ENABLE_S3_ARCHIVAL else None
+    headers = {'If-None-Match': cached[0]} if cached else {}
+    
+    # Go through QuartrAPI's request path for its concurrency cap and 429/5xx backoff. The request slot
+    # is held until the block exits, so only read the response here and upload after releasing it
+    async with QuartrAPI._request(session, 'GET', doc_url, headers=headers) as response:
+        status = response.status
+        etag = response.headers.get('ETag')
+        content_type = response.headers.get('content-type', 'application/pdf')
+        content = await response.read() if status == 200 else None
+    
+    if status == 304 and cached:
+        # Unchanged since it was archived, so reuse the existing S3 object
+        logger.info(f"{doc_type} at {doc_url} not modified, reusing {cached[1]['filename']}")
+        return dict(cached[1])
+    
+    if status != 200:
+        logger.error(f"Failed to download {doc_type} from {doc_url}: HTTP {status}")
+        return None
+    
+    original_filename = doc_url.split('/')[-1]
+    
+    # Remove any URL query parameters from the original filename
+    if '?' in original_filename:
+        original_filename = original_filename.split('?')[0]
+    
+    filename = storage_handler.create_filename(
+        company_name, event_date, event_title, doc_type, original_filename
+    )
+    
+    file_info = {
+        'filename': filename,
+        'display_name': os.path.basename(filename),
+        'type': doc_type,
+        'event_date': event_date,
+        'event_title': event_title,
+        'url': storage_handler.get_public_url(filename) if ENABLE_S3_ARCHIVAL else doc_url,
+        'storage_type': 'supabase'
+    }
+    
+    result = {
+        **file_info,
+        'data': content  # Keep bytes so queries skip the S3 download
+    }
+    
+    if ENABLE_S3_ARCHIVAL:
+        # Only mark the document archived (so its bytes may be released) and remember
+        # the ETag once the S3 copy they point at exists
+        def on_archived():
+            result['archived'] = file_info['archived'] = True
+            if etag:
+                etag_cache[doc_url] = (etag, dict(file_info))
+        
+        archive_in_background(
+            storage_handler, content, filename, content_type,
+            on_success=on_archived
+        )
+    
+    result['gemini_file'] = await upload_to_gemini_async(content)
+    return result
+
+# Function to fetch a transcript, render it to PDF and archive it in S3
+async def fetch_and_upload_transcript(session: aiohttp.ClientSession, storage_handler: AWSS3StorageHandler,
+                                      transcript_processor: TranscriptProcessor, event: Dict,
+                                      company_name: str, event_date: str, event_title: str) -> Optional[Dict]:
+    """Process an event transcript, upload its text to Gemini (archiving a PDF rendering in S3) and return its file information"""
+    # Get transcript data
+    transcripts = event.get('transcripts', {})
+    if not transcripts:
+        # If the transcripts object is empty, check for liveTranscripts
+        transcripts = event.get('liveTranscripts', {})
+    
+    transcript_text = await transcript_processor.process_transcript(
+        event.get('transcriptUrl'), transcripts, session
+    )
+    
+    if not transcript_text:
+        return None
+    
+    filename = storage_handler.create_filename(
+        company_name, event_date, event_title, 'transcript', 'transcript.pdf'
+    )
+    
+    # The transcript is already plain text, so Gemini gets that instead of the rendered PDF
+    text_data = transcript_text.encode('utf-8')
+    result = {
+        'filename': filename,
+        'display_name': os.path.basename(filename),
+        'type': 'transcript',
+        'event_date': event_date,
+        'event_title': event_title,
+        'url': storage_handler.get_public_url(filename) if ENABLE_S3_ARCHIVAL else event.get('transcriptUrl'),
+        'storage_type': 'supabase',
+        'data': text_data,  # Keep bytes so queries skip the S3 download
+        'mime_type': 'text/plain'
+    }
+    
+    # The PDF is only needed for the archived copy, so skip the reportlab pass when nothing is archived
+    if ENABLE_S3_ARCHIVAL:
+        # Rendering with reportlab is CPU-bound, so it runs in a worker process while other documents download
+        pdf_data = await transcript_processor.create_pdf_async(
+            company_name, event_title, event_date, transcript_text
+        )
+        archive_in_background(
+            storage_handler, pdf_data, filename, 'application/pdf',
+            on_success=lambda: result.update(archived=True)
+        )
+    
+    result['gemini_file'] = await upload_to_gemini_async(text_data, 'text/plain')
+    return result
 
 # Function to process company documents
-async def process_company_documents(company_id: str, company_name: str, event_type: str = "all") -> List[Dict]:
-    """Process company documents and return list of file information"""
+async def process_company_documents(company_id: str, company_name: str, event_type: str = "all") -> Tuple[List[Dict], List[str]]:
+    """Process company documents and return list of file information, with any error messages
+    
+    This runs on the background loop, which has no script context, so the caller shows the errors.
+    """
+    errors = []
     try:
-        async with aiohttp.ClientSession() as session:
-            # Initialize API and handlers
-            quartr_api = QuartrAPI()
-            storage_handler = AWSS3StorageHandler()
-            transcript_processor = TranscriptProcessor()
+        # Reuse the background loop's pooled connections to Quartr instead of a new session per company
+        session = await QuartrAPI.session()
+        
+        # Initialize API and handlers
+        quartr_api = QuartrAPI()
+        storage_handler = get_storage_handler()
+        transcript_processor = TranscriptProcessor()
+        
+        # Get company data from Quartr API using company ID
+        company_data = await quartr_api.get_company_events(company_id, session, event_type)
+        if not company_data:
+            logger.error(f"Failed to get company data for ID: {company_id}")
+            return [], errors
+        
+        # Use the company name passed in directly from Supabase
+        logger.info(f"Processing documents for company: {company_name} (ID: {company_id})")
             
-            # Get company data from Quartr API using company ID
-            company_data = await quartr_api.get_company_events(company_id, session, event_type)
-            if not company_data:
-                logger.error(f"Failed to get company data for ID: {company_id}")
-                return []
+        events = company_data.get('events', [])
+        if not events:
+            logger.warning(f"No events found for company: {company_name} (ID: {company_id})")
+            return [], errors
             
-            # Use the company name passed in directly from Supabase
-            logger.info(f"Processing documents for company: {company_name} (ID: {company_id})")
-                
-            events = company_data.get('events', [])
-            if not events:
-                logger.warning(f"No events found for company: {company_name} (ID: {company_id})")
-                return []
-                
-            # Sort events by date (descending) - should already be sorted, but just to be sure
-            events.sort(key=lambda x: x.get('eventDate', ''), reverse=True)
+        # Sort events by date (descending) - should already be sorted, but just to be sure
+        events.sort(key=lambda x: x.get('eventDate', ''), reverse=True)
+        
+        def event_details(event: Dict) -> Tuple[str, str]:
+            return event.get('eventDate', '').split('T')[0], event.get('eventTitle', 'Unknown Event')
+        
+        def fetch_slides(event: Dict):
+            return fetch_and_upload_document(
+                session, storage_handler, event['pdfUrl'], 'slides', company_name, *event_details(event)
+            )
+        
+        def fetch_report(event: Dict):
+            return fetch_and_upload_document(
+                session, storage_handler, event['reportUrl'], 'report', company_name, *event_details(event)
+            )
+        
+        def fetch_transcript(event: Dict):
+            return fetch_and_upload_transcript(
+                session, storage_handler, transcript_processor, event, company_name, *event_details(event)
+            )
+        
+        async def collect(doc_type: str, candidates: List[Dict], fetch: Callable, quota: int = 2) -> List[Dict]:
+            """Fetch the newest documents of one type concurrently, falling back to older events on failure"""
+            remaining = iter(candidates)
+            pending = {}
+            collected = []
+            
+            def launch():
+                event = next(remaining, None)
+                if event is not None:
+                    pending[asyncio.ensure_future(fetch(event))] = event
             
-            processed_files = []
-            transcript_count = 0
-            report_count = 0
-            pdf_count = 0
+            for _ in range(quota):
+                launch()
             
-            # Process up to 2 documents of each type
-            for event in events:
-                # Stop processing if we have enough documents (2 of each type)
-                if transcript_count >= 2 and report_count >= 2 and pdf_count >= 2:
-                    break
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    event = pending.pop(task)
+                    if task.exception():
+                        message = f"Error processing {doc_type} for {event_details(event)[1]}: {str(task.exception())}"
+                        logger.error(message)
+                        errors.append(message)
+                    elif task.result():
+                        collected.append(task.result())
                     
-                event_date = event.get('eventDate', '').split('T')[0]
-                event_title = event.get('eventTitle', 'Unknown Event')
-                
-                # Process PDF/slides (if we need more)
-                if pdf_count < 2 and event.get('pdfUrl'):
-                    try:
-                        async with session.get(event.get('pdfUrl')) as response:
-                            if response.status == 200:
-                                content = await response.read()
-                                original_filename = event.get('pdfUrl').split('/')[-1]
-                                
-                                # Remove any URL query parameters from the original filename
-                                if '?' in original_filename:
-                                    original_filename = original_filename.split('?')[0]
-                                
-                                filename = storage_handler.create_filename(
-                                    company_name, event_date, event_title, 'slides', original_filename
-                                )
-                                
-                                success = await storage_handler.upload_file(
-                                    content, filename, 
-                                    response.headers.get('content-type', 'application/pdf')
-                                )
-                                
-                                if success:
-                                    public_url = storage_handler.get_public_url(filename)
-                                    processed_files.append({
-                                        'filename': filename,
-                                        'type': 'slides',
-                                        'event_date': event_date,
-                                        'event_title': event_title,
-                                        'url': public_url,
-                                        'storage_type': 'supabase'
-                                    })
-                                    pdf_count += 1
-                    except Exception as e:
-                        st.error(f"Error processing slides for {event_title}: {str(e)}")
-                
-                # Process report (if we need more)
-                if report_count < 2 and event.get('reportUrl'):
-                    try:
-                        async with session.get(event.get('reportUrl')) as response:
-                            if response.status == 200:
-                                content = await response.read()
-                                original_filename = event.get('reportUrl').split('/')[-1]
-                                
-                                # Remove any URL query parameters from the original filename
-                                if '?' in original_filename:
-                                    original_filename = original_filename.split('?')[0]
-                                
-                                filename = storage_handler.create_filename(
-                                    company_name, event_date, event_title, 'report', original_filename
-                                )
-                                
-                                success = await storage_handler.upload_file(
-                                    content, filename, 
-                                    response.headers.get('content-type', 'application/pdf')
-                                )
-                                
-                                if success:
-                                    public_url = storage_handler.get_public_url(filename)
-                                    processed_files.append({
-                                        'filename': filename,
-                                        'type': 'report',
-                                        'event_date': event_date,
-                                        'event_title': event_title,
-                                        'url': public_url,
-                                        'storage_type': 'supabase'
-                                    })
-                                    report_count += 1
-                    except Exception as e:
-                        st.error(f"Error processing report for {event_title}: {str(e)}")
-                
-                # Only process the transcript if we need more
-                if transcript_count < 2 and event.get('transcriptUrl'):
-                    # Process transcript
-                    try:
-                        # Get transcript data
-                        transcripts = event.get('transcripts', {})
-                        if not transcripts:
-                            # If the transcripts object is empty, check for liveTranscripts
-                            transcripts = event.get('liveTranscripts', {})
-                        
-                        transcript_text = await transcript_processor.process_transcript(
-                            event.get('transcriptUrl'), transcripts, session
-                        )
-                        
-                        if transcript_text:
-                            pdf_data = transcript_processor.create_pdf(
-                                company_name, event_title, event_date, transcript_text
-                            )
-                            
-                            filename = storage_handler.create_filename(
-                                company_name, event_date, event_title, 'transcript', 'transcript.pdf'
-                            )
-                            
-                            success = await storage_handler.upload_file(
-                                pdf_data, filename, 'application/pdf'
-                            )
-                            
-                            if success:
-                                public_url = storage_handler.get_public_url(filename)
-                                processed_files.append({
-                                    'filename': filename,
-                                    'type': 'transcript',
-                                    'event_date': event_date,
-                                    'event_title': event_title,
-                                    'url': public_url,
-                                    'storage_type': 'supabase'
-                                })
-                                transcript_count += 1
-                    except Exception as e:
-                        st.error(f"Error processing transcript for {event_title}: {str(e)}")
+                    # Replace a failed fetch with the next older event, if the quota still needs it
+                    if len(collected) + len(pending) < quota:
+                        launch()
             
-            # Log the number of documents processed
-            logger.info(f"Processed {pdf_count} PDFs, {report_count} reports, and {transcript_count} transcripts")
-            return processed_files
+            # Keep newest first regardless of completion order
+            collected.sort(key=lambda f: f['event_date'], reverse=True)
+            return collected
+        
+        # Fetch and upload all document types in parallel
+        results = await asyncio.gather(
+            collect('slides', [e for e in events if e.get('pdfUrl')], fetch_slides),
+            collect('report', [e for e in events if e.get('reportUrl')], fetch_report),
+            collect('transcript', [e for e in events if e.get('transcriptUrl')], fetch_transcript)
+        )
+        processed_files = [file_info for files in results for file_info in files]
+        
+        # Log the number of documents processed
+        type_counts = {doc_type: sum(1 for f in processed_files if f['type'] == doc_type) for doc_type in ('slides', 'report', 'transcript')}
+        logger.info(f"Processed {type_counts['slides']} PDFs, {type_counts['report']} reports, and {type_counts['transcript']} transcripts")
+        return processed_files, errors
     except Exception as e:
-        st.error(f"Error processing company documents: {str(e)}")
-        return []
+        logger.error(f"Error processing company documents: {str(e)}")
+        errors.append(f"Error processing company documents: {str(e)}")
+        return [], errors
+
+# Create the S3 storage handler once per process so its boto3 connection pool survives reruns
+@st.cache_resource(show_spinner=False)
+def get_storage_handler() -> AWSS3StorageHandler:
+    handler = AWSS3StorageHandler()
+    if ENABLE_S3_ARCHIVAL:
+        # Archival uploads run on the background loop, so open its S3 connection before the first one
+        asyncio.run_coroutine_threadsafe(handler.warmup(), get_background_loop())
+    return handler
+
+# Function to extract the S3 key from a bucket URL
+def get_s3_key_from_url(file_url: str, bucket_name: str) -> str:
+    """Extract the object key from a virtual-hosted or path-style S3 URL"""
+    parsed_url = urlparse(file_url)
+    # Public URLs percent-encode the key, so decode it back to the stored object name
+    path = unquote(parsed_url.path.lstrip('/'))
+    
+    # Virtual-hosted style (bucket.s3.region.amazonaws.com/key) keeps the whole path as key
+    if parsed_url.netloc.startswith(f"{bucket_name}."):
+        return path
+    
+    # Path style (s3.region.amazonaws.com/bucket/key) drops the bucket segment
+    if path.startswith(f"{bucket_name}/"):
+        return path[len(bucket_name) + 1:]
+    return path
+
+# Function to get this session's download directory, removed when the process exits
+def get_session_tempdir() -> str:
+    """Create the session's temporary directory on first use and return its path"""
+    if "tempdir" not in st.session_state or not os.path.isdir(st.session_state.tempdir):
+        st.session_state.tempdir = tempfile.mkdtemp(prefix='fic_')
+        atexit.register(shutil.rmtree, st.session_state.tempdir, ignore_errors=True)
+    return st.session_state.tempdir
 
 # Function to download files from storage to temporary location
-async def download_files_from_s3(file_urls: List[str]) -> List[str]:
-    """Download files from AWS S3 storage to temporary location and return local paths"""
+async def download_files_from_s3(file_urls: List[str], temp_dir: str) -> Dict[str, str]:
+    """Download files from AWS S3 storage concurrently into temp_dir and return a URL to local path mapping"""
     try:
-        aws_handler = AWSS3StorageHandler()
-        temp_dir = tempfile.mkdtemp()
-        local_files = []
+        aws_handler = get_storage_handler()
         
-        # Create the asyncio event loop if not already running
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        # Run all downloads over the handler's long-lived S3 client and its connection pool
+        s3_async = await aws_handler.async_client()
         
-        # Download files
-        for file_url in file_urls:
-            try:
-                # Extract the S3 key from the URL
-                parsed_url = urlparse(file_url)
-                # Get the path portion of the URL
-                path = parsed_url.path
-                
-                # Extract the key part (remove leading slash and bucket name if present)
-                path_parts = path.split('/')
-                if len(path_parts) > 2:  # Format: /bucket-name/key
-                    s3_key = '/'.join(path_parts[2:])
-                else:  # Format: /key or key
-                    s3_key = path.lstrip('/')
+        async def download_one(file_url: str) -> str:
+            s3_key = get_s3_key_from_url(file_url, aws_handler.bucket_name)
+            local_path = os.path.join(temp_dir, s3_key.replace('/', '-'))
                 
-                safe_filename = s3_key.replace('/', '-')
-                local_path = os.path.join(temp_dir, safe_filename)
+            logger.info(f"Downloading {s3_key} from AWS S3 storage to {local_path}")
+            # download_fileobj streams the object in chunks instead of buffering it in memory
+            await download_s3_object(s3_async, aws_handler.bucket_name, s3_key, local_path)
                 
-                logger.info(f"Downloading {s3_key} from AWS S3 storage to {local_path}")
-                success = loop.run_until_complete(aws_handler.download_file(s3_key, local_path))
-                
-                if success:
-                    local_files.append(local_path)
-                    logger.info(f"Successfully downloaded {s3_key} to {local_path}")
-                else:
-                    logger.error(f"Failed to download {s3_key}")
-            except Exception as e:
-                logger.error(f"Error downloading file: {str(e)}")
+            logger.info(f"Successfully downloaded {s3_key} to {local_path}")
+            return local_path
+            
+        results = await asyncio.gather(*[download_one(url) for url in file_urls], return_exceptions=True)
+        
+        local_files = {}
+        for file_url, result in zip(file_urls, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error downloading file {file_url}: {str(result)}")
+            else:
+                local_files[file_url] = result
                 
         return local_files
     except Exception as e:
         logger.error(f"Error in download_files_from_s3: {str(e)}")
-        return []
+        return {}
+
+# Function to upload in-memory document bytes straight to Gemini
+def upload_bytes_to_gemini(data: bytes, mime_type: str = 'application/pdf'):
+    """Upload document bytes to the Gemini Files API without writing them to disk"""
+    if mime_type == 'application/pdf':
+        data, mime_type = extract_pdf_text(data)
+    return genai.upload_file(io.BytesIO(data), mime_type=mime_type)
+
+# Function to upload a downloaded PDF to Gemini without reading it into memory
+def upload_path_to_gemini(path: str):
+    """Upload a local PDF to the Gemini Files API, sending its text instead for text-native PDFs"""
+    text = read_pdf_text(path)
+    if text is not None:
+        return genai.upload_file(io.BytesIO(text), mime_type='text/plain')
+    
+    # The SDK streams the file from disk, so it never sits in a Python bytes object
+    return genai.upload_file(path, mime_type='application/pdf')
+
+# Minimum average characters per page for a PDF to count as text-native rather than scanned
+MIN_TEXT_CHARS_PER_PAGE = 200
+
+# Function to shrink text-native PDFs to their plain text before uploading
+def extract_pdf_text(data: bytes) -> Tuple[bytes, str]:
+    """Return (text bytes, 'text/plain') for text-native PDFs, or the original PDF bytes otherwise"""
+    text = read_pdf_text(data)
+    if text is None:
+        return data, 'application/pdf'
+    return text, 'text/plain'
+
+# Function to read the text of a PDF given as bytes or a local path
+def read_pdf_text(source: Union[bytes, str]) -> Optional[bytes]:
+    """Return the PDF's text as UTF-8 bytes, or None if it is scanned or cannot be read"""
+    if fitz is None:
+        return None
+    
+    try:
+        # fitz reads a path lazily from disk instead of needing the whole file in memory
+        with (fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)) as doc:
+            if not doc.page_count:
+                return None
+            
+            pages = [page.get_text() for page in doc]
+    except Exception as e:
+        logger.warning(f"Could not read PDF text, uploading original: {str(e)}")
+        return None
+    
+    # Scanned documents have little extractable text, so Gemini needs the original pages
+    if sum(len(page) for page in pages) / len(pages) < MIN_TEXT_CHARS_PER_PAGE:
+        return None
+    
+    text = "\n\n".join(f"--- Page {i} ---\n{page}" for i, page in enumerate(pages, 1)).encode('utf-8')
+    logger.info(f"Extracted {len(text)} bytes of text from PDF")
+    return text
+
+# Function to upload a document to Gemini while it is being archived in S3
+async def upload_to_gemini_async(data: bytes, mime_type: str = 'application/pdf'):
+    """Upload document bytes to Gemini in a worker thread, returning None on failure"""
+    if not initialize_gemini():
+        return None
+    try:
+        return await asyncio.to_thread(upload_bytes_to_gemini, data, mime_type)
+    except Exception as e:
+        logger.error(f"Error uploading document to Gemini: {str(e)}")
+        return None
+
+# Keep Gemini file handles per S3 URL for the lifetime of the process
+@st.cache_resource(show_spinner=False)
+def _gemini_file_cache() -> Dict[str, Any]:
+    """Return the process-wide S3 URL to Gemini file handle cache"""
+    return {}
+
+# Re-upload Gemini files this long before they expire (they are kept for 48 hours)
+GEMINI_FILE_REFRESH_MARGIN = timedelta(hours=8)
+
+# Function to look up a still-active Gemini file for a document without uploading
+def find_active_gemini_file(cache: Dict[str, Any], s3_url: str, file_name: Optional[str] = None):
+    """Return the cached Gemini file for the document if it is still active, otherwise None"""
+    gemini_file = cache.get(s3_url)
+    
+    # Fall back to the handle name remembered in the session if the resource cache was cleared
+    file_name = gemini_file.name if gemini_file else file_name
+    if not file_name:
+        return None
+    
+    try:
+        # Gemini only keeps uploaded files for ~48 hours, so refresh them before they lapse mid-conversation
+        gemini_file = genai.get_file(file_name)
+        expires_soon = gemini_file.expiration_time and gemini_file.expiration_time - datetime.now(timezone.utc) < GEMINI_FILE_REFRESH_MARGIN
+        if gemini_file.state.name == "ACTIVE" and not expires_soon:
+            cache[s3_url] = gemini_file
+            return gemini_file
+        logger.info(f"Gemini file {file_name} is {gemini_file.state.name} (expires {gemini_file.expiration_time}), re-uploading")
+    except Exception as e:
+        logger.warning(f"Cached Gemini file {file_name} is no longer available: {str(e)}")
+    return None
+
+# Function to get an active Gemini file handle for a document
+def get_gemini_file(cache: Dict[str, Any], s3_url: str, upload: Callable[[], Any], file_name: Optional[str] = None):
+    """Return a cached Gemini file for the document, calling upload() only if it expired"""
+    gemini_file = find_active_gemini_file(cache, s3_url, file_name)
+    if gemini_file is not None:
+        return gemini_file
+    
+    logger.info(f"Uploading {s3_url} to Gemini")
+    gemini_file = upload()
+    cache[s3_url] = gemini_file
+    return gemini_file
+
+# Function to get every processed file ready for Gemini in one pass
+async def prepare_gemini_files(processed_files: List[Dict], file_names: Dict[str, str],
+                               temp_dir: str) -> Tuple[List[Tuple[str, Any]], List[str]]:
+    """Reuse or upload Gemini files for all documents concurrently
+    
+    Returns (S3 URL, file) pairs and the names of documents that failed. This runs on the
+    background loop, which has no script context, so the caller reports failures.
+    """
+    if not initialize_gemini():
+        return [], []
+    
+    cache = _gemini_file_cache()
+    
+    # Handles uploaded during document processing seed the cache
+    for file_info in processed_files:
+        if file_info.get('gemini_file') is not None and file_info.get('url'):
+            cache.setdefault(file_info['url'], file_info['gemini_file'])
+    
+    # Check handles first, so S3 downloads only happen for documents Gemini no longer has
+    without_bytes = [file_info for file_info in processed_files if 'url' in file_info and not file_info.get('data')]
+    active = await asyncio.gather(*[
+        asyncio.to_thread(find_active_gemini_file, cache, file_info['url'], file_names.get(file_info['url']))
+        for file_info in without_bytes
+    ], return_exceptions=True)
+    active_urls = {
+        file_info['url'] for file_info, result in zip(without_bytes, active)
+        if result is not None and not isinstance(result, Exception)
+    }
+    missing_urls = [file_info['url'] for file_info in without_bytes if file_info['url'] not in active_urls]
+    
+    downloaded = {}
+    if missing_urls:
+        logger.info(f"Downloading {len(missing_urls)} files without cached bytes from S3")
+        downloaded = await download_files_from_s3(missing_urls, temp_dir)
+    
+    async def prepare_one(file_info: Dict):
+        s3_url = file_info.get('url')
+        if s3_url in active_urls:
+            return cache[s3_url]
+        elif file_info.get('data'):
+            # Re-uploads go straight from memory, never through disk
+            data = file_info['data']
+            mime_type = file_info.get('mime_type', 'application/pdf')
+            upload = lambda: upload_bytes_to_gemini(data, mime_type)
+        elif s3_url in downloaded:
+            local_path = downloaded[s3_url]
+            upload = lambda: upload_path_to_gemini(local_path)
+        else:
+            # Reported in failed, so the document doesn't drop out of the answer context unnoticed
+            raise RuntimeError("no cached bytes and the S3 download failed")
+        
+        try:
+            # genai calls are blocking HTTP requests, so run them in worker threads
+            return await asyncio.to_thread(get_gemini_file, cache, s3_url, upload, file_names.get(s3_url))
+        finally:
+            if s3_url in downloaded:
+                # The local copy is only needed for the upload
+                os.remove(downloaded[s3_url])
+    
+    results = await asyncio.gather(*[prepare_one(file_info) for file_info in processed_files], return_exceptions=True)
+    
+    # Results follow processed_files order so the prompt sees documents consistently
+    gemini_files = []
+    failed = []
+    for file_info, result in zip(processed_files, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error preparing {file_info.get('filename')} for Gemini: {str(result)}")
+            failed.append(file_info.get('filename', file_info.get('url')))
+        elif result is not None:
+            gemini_files.append((file_info['url'], result))
+    
+    return gemini_files, failed
+
+# Maximum number of companies whose processed documents are kept per session
+MAX_CACHED_COMPANIES = 5
+
+# Function to remember processed documents for a company in this session
+def cache_company_documents(quartr_id: str, processed_files: List[Dict]) -> None:
+    """Store processed files for a company, evicting the least recently used company if needed"""
+    docs_by_company = st.session_state.docs_by_company
+    docs_by_company[quartr_id] = processed_files
+    docs_by_company.move_to_end(quartr_id)
+    while len(docs_by_company) > MAX_CACHED_COMPANIES:
+        evicted_id, _ = docs_by_company.popitem(last=False)
+        logger.info(f"Evicted cached documents for Quartr ID {evicted_id}")
+
+# Longest the first question waits on a prefetch before fetching the documents itself,
+# and on that inline fetch before giving up
+PREFETCH_WAIT_TIMEOUT = 120
+DOCUMENT_FETCH_TIMEOUT = 120
+
+# Function to fetch a company's documents in the background
+def prefetch_company_documents(quartr_id: str, company_name: str) -> concurrent.futures.Future:
+    """Run process_company_documents on the background loop, sharing its pooled connections"""
+    logger.info(f"Prefetching documents for {company_name} (ID: {quartr_id})")
+    return asyncio.run_coroutine_threadsafe(process_company_documents(quartr_id, company_name), get_background_loop())
+
+# Function to drop in-memory document bytes once they are no longer on the query path
+def release_document_bytes(processed_files: List[Dict]) -> None:
+    """Remove cached document bytes once S3 holds a copy to re-upload from if Gemini ever needs one"""
+    for file_info in processed_files:
+        # Unarchived documents (archival disabled, or the upload failed) have no other copy to fall back on
+        if file_info.get('archived'):
+            file_info.pop('data', None)
+
+# Run coroutines on the shared background loop, so sessions reuse its pooled connections and clients
+# instead of each leaking a loop of its own
+def run_async(coro, timeout: Optional[float] = None):
+    """Run a coroutine to completion on the background loop and return its result
+    
+    Raises concurrent.futures.TimeoutError after timeout seconds, cancelling the coroutine.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+# Share in-flight Gemini answers between sessions asking the same thing
+@st.cache_resource(show_spinner=False)
+def _gemini_inflight() -> Tuple[threading.Lock, Dict[Tuple, concurrent.futures.Future]]:
+    """Return the process-wide lock and request key to pending answer map"""
+    return threading.Lock(), {}
+
+def coalesce_gemini_request(key: Tuple, generate: Callable[[], str]) -> str:
+    """Run generate() once per key, letting concurrent identical requests wait for the same answer"""
+    lock, inflight = _gemini_inflight()
+    with lock:
+        future = inflight.get(key)
+        owner = future is None
+        if owner:
+            future = concurrent.futures.Future()
+            inflight[key] = future
+    
+    if not owner:
+        logger.info("Gemini API: Joining identical in-flight request")
+        return future.result()
+    
+    try:
+        future.set_result(generate())
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with lock:
+            inflight.pop(key, None)
+    return future.result()
+
+# Function to answer a prompt against a document set, memoised for repeated questions
+@st.cache_data(ttl=60*60, max_entries=256, show_spinner=False)  # Cache for 1 hour
+def generate_gemini_answer(file_names: Tuple[str, ...], prompt: str, _gemini_files: List[Any]) -> str:
+    """Return Gemini's answer for the prompt; failures raise, so only successful answers are cached"""
+    def generate() -> str:
+        # Get the shared model, backed by a cached context for this document set when possible
+        model, contents = get_gemini_model_for_files(_gemini_files)
+        return model.generate_content([*contents, prompt]).text
+    
+    return coalesce_gemini_request((file_names, prompt), generate)
 
 # Function to query Gemini with file context
-async def query_gemini_async(query: str, file_paths: List[str], conversation_context=None) -> str:
+async def query_gemini_async(query: str, gemini_files: List[Any], conversation_context=None) -> str:
     """Query Gemini model with context from files (async version)"""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: query_gemini(query, file_paths, conversation_context))
+    return await loop.run_in_executor(None, lambda: query_gemini(query, gemini_files, conversation_context))
 
-def query_gemini(query: str, file_paths: List[str], conversation_context=None) -> str:
-    """Query Gemini model with context from files"""
+def query_gemini(query: str, gemini_files: List[Any], conversation_context=None) -> str:
+    """Query Gemini model with context from uploaded Gemini files"""
     try:
-        logger.info(f"Gemini API: Starting analysis with {len(file_paths)} documents")
+        logger.info(f"Gemini API: Starting analysis with {len(gemini_files)} documents")
         start_time = time.time()
         
-        # Make sure Gemini is initialized
-        if not initialize_gemini():
-            return "Error initializing Gemini client"
+        if not gemini_files:
+            return "No files were successfully processed for Gemini"
         
-        # Create a model instance with proper configuration
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash',
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=7000
-            )
-        )
+        if not get_gemini_model():
+            return "Error initializing Gemini client"
         
         # Build conversation history for context (safely)
         conversation_history = ""
@@ -601,41 +1056,14 @@ def query_gemini(query: str, file_paths: List[str], conversation_context=None) -
                 conversation_history += f"Question: {entry['query']}\n"
                 conversation_history += f"Answer: {entry['summary']}\n\n"
         
-        # Prepare files and content parts
-        contents = []
-        
-        # Add files to contents
-        logger.info("Gemini API: Processing document files")
-        file_start_time = time.time()
-        for file_path in file_paths:
-            try:
-                # Open the file and create a content part
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                    
-                # Add file data as content part
-                file_mime_type = 'application/pdf'  # Assuming all files are PDFs
-                contents.append({
-                    'mime_type': file_mime_type,
-                    'data': file_data
-                })
-            except Exception as e:
-                st.error(f"Error processing file for Gemini: {str(e)}")
-        
-        file_processing_time = time.time() - file_start_time
-        logger.info(f"Gemini API: Processed {len(contents)} files in {file_processing_time:.2f} seconds")
-        
-        if not contents:
-            return "No files were successfully processed for Gemini"
-        
-        # Add the prompt as the final content
-        prompt = f"You are a senior financial analyst. Review the attached documents and provide a detailed and structured answer to the user's query. User's query: '{query}'\n\n{conversation_history}"
-        contents.append(prompt)
+        # The system instruction lives on the model, so only the query and history are sent
+        prompt = f"User's query: '{query}'\n\n{conversation_history}"
         
         # Generate content with files as context
         logger.info("Gemini API: Sending request to API")
         api_start_time = time.time()
-        response = model.generate_content(contents)
+        file_names = tuple(getattr(f, 'name', str(f)) for f in gemini_files)
+        response_text = generate_gemini_answer(file_names, prompt, gemini_files)
         api_time = time.time() - api_start_time
         logger.info(f"Gemini API: Received response in {api_time:.2f} seconds")
         
@@ -643,69 +1071,68 @@ def query_gemini(query: str, file_paths: List[str], conversation_context=None) -
         logger.info(f"Gemini API: Total processing time: {total_time:.2f} seconds")
         
         # Return the response text
-        return response.text
+        return response_text
     except Exception as e:
         st.error(f"Error querying Gemini: {str(e)}")
         return f"An error occurred while processing your query: {str(e)}"
 
-# Main UI components
-def main():
-    st.title("Financial Insights Chat")
+# Pre-signed source links stay valid for a day and are re-signed shortly before they lapse
+PRESIGNED_URL_TTL = 24 * 60 * 60
+PRESIGNED_URL_MARGIN = 5 * 60
+
+# Function to get a link to an archived document that opens whether or not the bucket is public
+def get_source_link(file_info: Dict) -> str:
+    """Return a cached pre-signed S3 URL for the document, signing it again only when expired"""
+    if time.time() < file_info.get('link_expires', 0) - PRESIGNED_URL_MARGIN:
+        return file_info['link_url']
     
-    # Load company data
-    company_data = load_company_data()
-    if company_data is None:
-        st.error("Failed to load company data. Please check the Supabase connection.")
-        return
+    storage_handler = get_storage_handler()
+    url = file_info['url']
+    if not urlparse(url).netloc.startswith(f"{storage_handler.bucket_name}."):
+        # Not archived in our bucket (S3 archival disabled), so link to the source directly
+        return url
     
-    # Sidebar with company selection
-    with st.sidebar:
-        st.header("Select Company")
-        company_names = get_company_names()
-        selected_company = st.selectbox(
-            "Choose a company:",
-            options=company_names,
-            index=0 if company_names else None
-        )
-        
-        if selected_company:
-            # Get both Quartr ID (primary) and ISIN (legacy)
-            quartr_id = get_quartrid_by_name(selected_company)
-            isin = get_isin_by_name(selected_company)
-            
-            # Display Quartr ID for debugging
-            st.info(f"Quartr ID: {quartr_id}")
-            
-            # Check if company changed
-            if st.session_state.current_company != selected_company:
-                st.session_state.current_company = selected_company
-                st.session_state.company_data = {
-                    'name': selected_company,
-                    'isin': isin,  # Keep for backward compatibility
-                    'quartr_id': quartr_id  # Primary identifier
-                }
-                
-                # Clear previous conversation when company changes
-                st.session_state.chat_history = []
-                st.session_state.processed_files = []
-                st.session_state.documents_fetched = False
-                st.session_state.conversation_context = []
-        
-        # Add information about conversation capabilities
-        st.markdown("---")
-        st.markdown("### Conversation Features")
-        st.info("This app now supports follow-up questions! The AI will remember previous exchanges and provide contextual responses.")
+    # Signing is local crypto, so this makes no network call
+    signed = storage_handler.get_presigned_url(file_info['filename'], expiration=PRESIGNED_URL_TTL)
+    if not signed:
+        return url
     
-    # Main chat area
-    for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    file_info['link_url'] = signed
+    file_info['link_expires'] = time.time() + PRESIGNED_URL_TTL
+    return signed
+
+# Function to get the "Company data" sources block for the current documents
+def get_document_sources(processed_files: List[Dict]) -> str:
+    """Build the document sources Markdown once per document set and reuse it on later turns"""
+    key = tuple((file_info.get('filename'), file_info.get('url')) for file_info in processed_files)
+    cached = st.session_state.get("document_sources")
+    if cached and cached[0] == key and time.time() < cached[2]:
+        return cached[1]
+    
+    # Add document sources under "Company data" sub-header
+    sources = "\n#### Company data\n"
+    for i, file_info in enumerate(processed_files, 1):
+        # Get URL from file info
+        if 'url' in file_info:
+            sources += f"{i}. [{file_info['display_name']}]({get_source_link(file_info)})\n"
+    
+    # Rebuild once the first pre-signed link in the block is about to expire
+    expires_at = min((file_info.get('link_expires', float('inf')) for file_info in processed_files), default=float('inf'))
+    st.session_state.document_sources = (key, sources, expires_at - PRESIGNED_URL_MARGIN)
+    return sources
+
+# Chat area, rerun on its own so a new message does not re-render the sidebar
+@st.fragment
+def chat_area():
+    for role, content in st.session_state.chat_history:
+        with st.chat_message(role):
+            st.markdown(content)
     
     # Main chat input section
     # Chat input with updated placeholder
     if query := st.chat_input("Ask about the company or follow up on previous answers..."):
         # Add user message to chat history
-        st.session_state.chat_history.append({"role": "user", "content": query})
+        st.session_state.chat_history.append(("user", query))
         with st.chat_message("user"):
             st.markdown(query)
         
@@ -718,7 +1145,7 @@ def main():
             if not st.session_state.company_data:
                 response = "Please select a company from the sidebar first."
                 response_placeholder.markdown(response)
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
+                st.session_state.chat_history.append(("assistant", response))
                 return
             
             # Get company name for Perplexity
@@ -727,22 +1154,10 @@ def main():
             # Get conversation context safely before starting thread
             conversation_context = list(st.session_state.conversation_context) if "conversation_context" in st.session_state else []
             
-            # Create an event loop in a new thread for Perplexity
-            perplexity_loop = asyncio.new_event_loop()
-            
-            # Define a function to run the Perplexity query in a separate thread
-            def run_perplexity_query():
-                asyncio.set_event_loop(perplexity_loop)
-                perplexity_loop.run_forever()
-            
-            # Start the perplexity thread
-            perplexity_thread = threading.Thread(target=run_perplexity_query, daemon=True)
-            perplexity_thread.start()
-            
-            # Start Perplexity API call immediately
+            # Start Perplexity API call immediately on the background loop, so it runs while documents are prepared
             logger.info(f"Starting Perplexity API call immediately for query about {company_name}")
             start_time = time.time()
-            perplexity_future = asyncio.run_coroutine_threadsafe(query_perplexity(query, company_name, conversation_context), perplexity_loop)
+            perplexity_future = asyncio.run_coroutine_threadsafe(query_perplexity(query, company_name, conversation_context), get_background_loop())
             
             try:
                 # Fetch documents if not already fetched
@@ -753,48 +1168,76 @@ def main():
                         if not quartr_id:
                             response = "No Quartr ID found for this company. Please select another company."
                             response_placeholder.markdown(response)
-                            st.session_state.chat_history.append({"role": "assistant", "content": response})
+                            st.session_state.chat_history.append(("assistant", response))
                             # Clean up
                             perplexity_future.cancel()
-                            perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                            perplexity_thread.join(timeout=1.0)
                             return
                             
-                        # Process company documents using the Quartr ID
-                        processed_files = asyncio.run(process_company_documents(quartr_id, st.session_state.company_data['name']))
+                        # Use the fetch started on company selection, or fetch now using the Quartr ID
+                        prefetch = st.session_state.get("prefetch")
+                        result = None
+                        if prefetch and prefetch[0] == quartr_id:
+                            try:
+                                result = prefetch[1].result(timeout=PREFETCH_WAIT_TIMEOUT)
+                            except concurrent.futures.TimeoutError:
+                                logger.warning(f"Prefetch for Quartr ID {quartr_id} timed out, fetching again")
+                                prefetch[1].cancel()
+                        if result is None:
+                            try:
+                                result = run_async(
+                                    process_company_documents(quartr_id, st.session_state.company_data['name']),
+                                    timeout=DOCUMENT_FETCH_TIMEOUT
+                                )
+                            except concurrent.futures.TimeoutError:
+                                logger.error(f"Fetching documents for Quartr ID {quartr_id} timed out")
+                                st.session_state.prefetch = None
+                                response = "Fetching documents for this company timed out. Please try again."
+                                response_placeholder.markdown(response)
+                                st.session_state.chat_history.append(("assistant", response))
+                                # Clean up
+                                perplexity_future.cancel()
+                                return
+                        processed_files, errors = result
+                        for error in errors:
+                            st.error(error)
+                        st.session_state.prefetch = None
                         st.session_state.processed_files = processed_files
                         st.session_state.documents_fetched = True
+                        cache_company_documents(quartr_id, processed_files)
                         
                         if not processed_files:
                             response = "No documents found for this company. Please try another company or check your Quartr API key."
                             response_placeholder.markdown(response)
-                            st.session_state.chat_history.append({"role": "assistant", "content": response})
+                            st.session_state.chat_history.append(("assistant", response))
                             # Clean up
                             perplexity_future.cancel()
-                            perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                            perplexity_thread.join(timeout=1.0)
                             return
                 
                 # Process the user query with fetched documents (for both new and follow-up questions)
                 if st.session_state.processed_files:
                     with st.spinner("Processing your query with multiple AI models..."):
-                        # Download files from storage
-                        local_files = asyncio.run(download_files_from_s3([file_info['url'] for file_info in st.session_state.processed_files]))
+                        # Get Gemini files for all documents concurrently (handles from the fetch are reused)
+                        gemini_files, failed = run_async(prepare_gemini_files(
+                            st.session_state.processed_files,
+                            dict(st.session_state.gemini_file_names),
+                            get_session_tempdir()
+                        ))
+                        if failed:
+                            st.error(f"Could not prepare {len(failed)} document(s) for Gemini: {', '.join(failed)}")
+                        st.session_state.gemini_file_names.update({s3_url: gemini_file.name for s3_url, gemini_file in gemini_files})
                         
-                        if not local_files:
+                        if not gemini_files:
                             response = "Error downloading files from storage. Please check your connection."
                             response_placeholder.markdown(response)
-                            st.session_state.chat_history.append({"role": "assistant", "content": response})
+                            st.session_state.chat_history.append(("assistant", response))
                             # Clean up
                             perplexity_future.cancel()
-                            perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                            perplexity_thread.join(timeout=1.0)
                             return
                         
                         # Run Gemini analysis on documents
                         logger.info("Starting Gemini analysis on documents")
                         gemini_start = time.time()
-                        gemini_output = query_gemini(query, local_files, conversation_context)
+                        gemini_output = query_gemini(query, [gemini_file for _, gemini_file in gemini_files], conversation_context)
                         gemini_duration = time.time() - gemini_start
                         logger.info(f"Completed Gemini analysis in {gemini_duration:.2f} seconds")
                         
@@ -816,14 +1259,6 @@ def main():
                             perplexity_output = "Error: Perplexity API request timed out or failed."
                             perplexity_citations = []
                         
-                        # Clean up the perplexity thread and loop
-                        try:
-                            perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                            perplexity_thread.join(timeout=1.0)
-                            logger.info("Successfully cleaned up Perplexity thread")
-                        except Exception as e:
-                            logger.error(f"Error cleaning up Perplexity thread: {str(e)}")
-                        
                         # Log completion 
                         logger.info("Completed first-stage LLM processing (Gemini and Perplexity)")
                         logger.info(f"Gemini output length: {len(gemini_output)} characters")
@@ -833,27 +1268,22 @@ def main():
                         if gemini_output.startswith("Error") and perplexity_output.startswith("Error"):
                             response = "Both Gemini and Perplexity APIs failed. Please try again later."
                             response_placeholder.markdown(response)
-                            st.session_state.chat_history.append({"role": "assistant", "content": response})
+                            st.session_state.chat_history.append(("assistant", response))
                             return
                         
                         # Process with Claude
                         logger.info("Starting final synthesis with Claude")
                         claude_start = time.time()
-                        claude_response = query_claude(query, company_name, gemini_output, perplexity_output, conversation_context)
+                        # Stream the synthesis into the chat so users see the answer as it is generated
+                        claude_response = response_placeholder.write_stream(
+                            stream_claude(query, company_name, gemini_output, perplexity_output, conversation_context)
+                        )
                         claude_duration = time.time() - claude_start
                         logger.info(f"Completed Claude synthesis in {claude_duration:.2f} seconds")
                         
-                        # Format sources section
+                        # Format sources section, reusing the document list built for this document set
                         sources_section = "\n\n### Sources\n"
-                        
-                        # Add document sources under "Company data" sub-header
-                        sources_section += "\n#### Company data\n"
-                        for i, file_info in enumerate(st.session_state.processed_files, 1):
-                            # Get URL from file info
-                            if 'url' in file_info:
-                                url = file_info['url']
-                                filename = os.path.basename(file_info['filename'])
-                                sources_section += f"{i}. [{filename}]({url})\n"
+                        sources_section += get_document_sources(st.session_state.processed_files)
                         
                         # Add Perplexity attribution and citations under "Web sources" sub-header
                         sources_section += "\n#### Web sources\n"
@@ -898,7 +1328,7 @@ def main():
                         response_placeholder.markdown(final_response)
                         
                         # Add assistant response to chat history
-                        st.session_state.chat_history.append({"role": "assistant", "content": final_response})
+                        st.session_state.chat_history.append(("assistant", final_response))
                         
                         # Save condensed version of the response to conversation context
                         # Extract the response without the sources section
@@ -916,21 +1346,86 @@ def main():
                 else:
                     response = "No documents are available for this company. Please try another company."
                     response_placeholder.markdown(response)
-                    st.session_state.chat_history.append({"role": "assistant", "content": response})
+                    st.session_state.chat_history.append(("assistant", response))
                     # Clean up
                     perplexity_future.cancel()
-                    perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                    perplexity_thread.join(timeout=1.0)
             except Exception as e:
                 # Handle any unexpected errors
                 logger.error(f"Unexpected error during processing: {str(e)}")
                 response = f"An unexpected error occurred: {str(e)}"
                 response_placeholder.markdown(response)
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
+                st.session_state.chat_history.append(("assistant", response))
                 # Clean up
                 perplexity_future.cancel()
-                perplexity_loop.call_soon_threadsafe(perplexity_loop.stop)
-                perplexity_thread.join(timeout=1.0)
+
+# Main UI components
+def main():
+    st.title("Financial Insights Chat")
+    
+    # Load company data
+    try:
+        company_names, company_lookup = get_company_lookup()
+    except RuntimeError:
+        st.error("Failed to load company data. Please check the Supabase connection.")
+        return
+    
+    # Sidebar with company selection
+    with st.sidebar:
+        st.header("Select Company")
+        selected_company = st.selectbox(
+            "Choose a company:",
+            options=company_names,
+            index=0 if company_names else None
+        )
+        
+        if selected_company:
+            # Get both Quartr ID (primary) and ISIN (legacy)
+            company_ids = company_lookup.get(selected_company, {})
+            quartr_id = company_ids.get('quartr_id') or get_quartrid_by_name(selected_company)
+            isin = company_ids.get('isin')
+            
+            # Display Quartr ID for debugging
+            st.info(f"Quartr ID: {quartr_id}")
+            
+            # Check if company changed
+            if st.session_state.current_company != selected_company:
+                # The previous company's Gemini files stay cached, so its PDF bytes can go
+                release_document_bytes(st.session_state.processed_files)
+                
+                st.session_state.current_company = selected_company
+                st.session_state.company_data = {
+                    'name': selected_company,
+                    'isin': isin,  # Keep for backward compatibility
+                    'quartr_id': quartr_id  # Primary identifier
+                }
+                
+                # Clear previous conversation when company changes
+                st.session_state.chat_history = deque(maxlen=MAX_CHAT_MESSAGES)
+                st.session_state.conversation_context = []
+                
+                # Reuse documents already fetched for this company earlier in the session
+                cached_files = st.session_state.docs_by_company.get(quartr_id) if quartr_id else None
+                if cached_files is not None:
+                    st.session_state.docs_by_company.move_to_end(quartr_id)
+                st.session_state.processed_files = cached_files or []
+                st.session_state.documents_fetched = cached_files is not None
+                
+                # Start fetching documents now so they are ready by the time the first question arrives;
+                # a previous company's unfinished prefetch would only compete for the shared loop
+                previous = st.session_state.get("prefetch")
+                if previous:
+                    previous[1].cancel()
+                st.session_state.prefetch = None
+                if cached_files is None and quartr_id:
+                    st.session_state.prefetch = (quartr_id, prefetch_company_documents(quartr_id, selected_company))
+        
+        # Add information about conversation capabilities
+        st.markdown("---")
+        st.markdown("### Conversation Features")
+        st.info("This app now supports follow-up questions! The AI will remember previous exchanges and provide contextual responses.")
+    
+    # Main chat area
+    chat_area()
 
 if __name__ == "__main__":
     main()
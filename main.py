@@ -1,17 +1,18 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import os
 import asyncio
 import aiohttp
 import time
-import logging
 import json
+import tempfile
 import google.generativeai as genai
 import anthropic
 from dotenv import load_dotenv
+from functools import lru_cache
 from typing import Dict, List, Optional, Any, Tuple
-from utils import QuartrAPI, AWSS3StorageHandler, TranscriptProcessor
-from supabase_client import get_quartrid_by_name
+from utils import QuartrAPI, AWSS3StorageHandler, TranscriptProcessor, MULTIPART_THRESHOLD, shutdown_pdf_pool, json_dumps
+from supabase_client import get_quartrid_by_name, warm_cache
 from logger import logger
 from urllib.parse import urlparse  # For parsing citation URLs
 
@@ -166,7 +167,7 @@ async def query_perplexity(query: str, company_name: str, conversation_context=N
         timeout = aiohttp.ClientTimeout(total=45)  # 45 second timeout
         
         # Use aiohttp to make the request asynchronously
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with aiohttp.ClientSession(timeout=timeout, json_serialize=json_dumps) as session:
             logger.info("Perplexity API: Sending request to API server")
             async with session.post(url, json=payload, headers=headers) as response:
                 if response.status != 200:
@@ -285,174 +286,185 @@ PERPLEXITY OUTPUT (Based on web search):
         logger.error(f"Error calling Claude API: {str(e)}")
         return f"Error calling Claude API: {str(e)}"
 
+# One storage handler per process, so its S3 clients and connection pools are reused across requests
+@lru_cache(maxsize=1)
+def get_storage_handler() -> AWSS3StorageHandler:
+    return AWSS3StorageHandler()
+
 # Function to process company documents and generate embeddings
 async def process_company_documents(company_id: str, company_name: str, event_type: str = "all") -> List[Dict]:
     """Process company documents and return list of file information"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Initialize API and handlers
-            quartr_api = QuartrAPI()
-            storage_handler = AWSS3StorageHandler()
-            transcript_processor = TranscriptProcessor()
+        # One pooled session per event loop, shared across requests
+        session = await QuartrAPI.session()
+        
+        # Initialize API and handlers
+        quartr_api = QuartrAPI()
+        storage_handler = get_storage_handler()
+        transcript_processor = TranscriptProcessor()
             
-            # Get company data from Quartr API using company ID
-            company_data = await quartr_api.get_company_events(company_id, session, event_type)
-            if not company_data:
-                logger.error(f"Failed to get company data for ID: {company_id}")
-                return []
+        # Get company data from Quartr API using company ID
+        company_data = await quartr_api.get_company_events(company_id, session, event_type)
+        if not company_data:
+            logger.error(f"Failed to get company data for ID: {company_id}")
+            return []
             
-            logger.info(f"Processing documents for company: {company_name} (ID: {company_id})")
+        logger.info(f"Processing documents for company: {company_name} (ID: {company_id})")
                 
-            events = company_data.get('events', [])
-            if not events:
-                logger.warning(f"No events found for company: {company_name} (ID: {company_id})")
-                return []
+        events = company_data.get('events', [])
+        if not events:
+            logger.warning(f"No events found for company: {company_name} (ID: {company_id})")
+            return []
                 
-            # Sort events by date (descending)
-            events.sort(key=lambda x: x.get('eventDate', ''), reverse=True)
+        # Sort events by date (descending)
+        events.sort(key=lambda x: x.get('eventDate', ''), reverse=True)
             
-            processed_files = []
-            transcript_count = 0
-            report_count = 0
-            pdf_count = 0
+        processed_files = []
+        transcript_count = 0
+        report_count = 0
+        pdf_count = 0
             
-            # Process up to 2 documents of each type
-            for event in events:
-                # Stop processing if we have enough documents (2 of each type)
-                if transcript_count >= 2 and report_count >= 2 and pdf_count >= 2:
-                    break
+        # Process up to 2 documents of each type
+        for event in events:
+            # Stop processing if we have enough documents (2 of each type)
+            if transcript_count >= 2 and report_count >= 2 and pdf_count >= 2:
+                break
                     
-                event_date = event.get('eventDate', '').split('T')[0] if 'T' in event.get('eventDate', '') else event.get('eventDate', '')
-                event_title = event.get('eventTitle', event.get('title', 'Unknown Event'))
+            event_date = event.get('eventDate', '').split('T')[0] if 'T' in event.get('eventDate', '') else event.get('eventDate', '')
+            event_title = event.get('eventTitle', event.get('title', 'Unknown Event'))
                 
-                # Log event details for debugging
-                logger.info(f"Processing event: {event_title} from {event_date}")
+            # Log event details for debugging
+            logger.info(f"Processing event: {event_title} from {event_date}")
                 
-                # Process PDF/slides (if we need more)
-                if pdf_count < 2 and event.get('pdfUrl'):
-                    try:
-                        # Log the URL we're trying to download
-                        logger.info(f"Attempting to download slides from: {event.get('pdfUrl')}")
+            # Process PDF/slides (if we need more)
+            if pdf_count < 2 and event.get('pdfUrl'):
+                try:
+                    # Log the URL we're trying to download
+                    logger.info(f"Attempting to download slides from: {event.get('pdfUrl')}")
                         
-                        async with session.get(event.get('pdfUrl')) as response:
-                            if response.status == 200:
-                                content = await response.read()
-                                original_filename = event.get('pdfUrl').split('/')[-1]
+                    # Stream the body into a spool that moves to disk past the multipart threshold,
+                    # so large documents are never held in memory whole
+                    with tempfile.SpooledTemporaryFile(max_size=MULTIPART_THRESHOLD) as content:
+                        if await quartr_api.get_document(event.get('pdfUrl'), session, sink=content):
+                            original_filename = event.get('pdfUrl').split('/')[-1]
                                 
-                                # Remove any URL query parameters from the original filename
-                                if '?' in original_filename:
-                                    original_filename = original_filename.split('?')[0]
+                            # Remove any URL query parameters from the original filename
+                            if '?' in original_filename:
+                                original_filename = original_filename.split('?')[0]
                                 
-                                filename = storage_handler.create_filename(
-                                    company_name, event_date, event_title, 'slides', original_filename
-                                )
+                            filename = storage_handler.create_filename(
+                                company_name, event_date, event_title, 'slides', original_filename
+                            )
                                 
-                                success = await storage_handler.upload_file(
-                                    content, filename, 'application/pdf'
-                                )
+                            content.seek(0)
+                            success = await storage_handler.upload_fileobj(
+                                content, filename, 'application/pdf'
+                            )
                                 
-                                if success:
-                                    public_url = storage_handler.get_public_url(filename)
-                                    processed_files.append({
-                                        'filename': filename,
-                                        'type': 'presentation',
-                                        'title': event_title,
-                                        'date': event_date,
-                                        'url': public_url
-                                    })
-                                    pdf_count += 1
-                                    logger.info(f"Successfully processed and stored slides: {filename}")
-                            else:
-                                logger.error(f"Failed to download slides: HTTP {response.status}")
-                    except Exception as e:
-                        logger.error(f"Error processing slides for {event_title}: {str(e)}")
+                            if success:
+                                public_url = storage_handler.get_public_url(filename)
+                                processed_files.append({
+                                    'filename': filename,
+                                    'type': 'presentation',
+                                    'title': event_title,
+                                    'date': event_date,
+                                    'url': public_url
+                                })
+                                pdf_count += 1
+                                logger.info(f"Successfully processed and stored slides: {filename}")
+                        else:
+                            logger.error(f"Failed to download slides")
+                except Exception as e:
+                    logger.error(f"Error processing slides for {event_title}: {str(e)}")
                 
-                # Process report (if we need more)
-                if report_count < 2 and event.get('reportUrl'):
-                    try:
-                        # Log the URL we're trying to download
-                        logger.info(f"Attempting to download report from: {event.get('reportUrl')}")
+            # Process report (if we need more)
+            if report_count < 2 and event.get('reportUrl'):
+                try:
+                    # Log the URL we're trying to download
+                    logger.info(f"Attempting to download report from: {event.get('reportUrl')}")
                         
-                        async with session.get(event.get('reportUrl')) as response:
-                            if response.status == 200:
-                                content = await response.read()
-                                original_filename = event.get('reportUrl').split('/')[-1]
-                                
-                                # Remove any URL query parameters from the original filename
-                                if '?' in original_filename:
-                                    original_filename = original_filename.split('?')[0]
+                    # Stream the body into a spool that moves to disk past the multipart threshold,
+                    # so large documents are never held in memory whole
+                    with tempfile.SpooledTemporaryFile(max_size=MULTIPART_THRESHOLD) as content:
+                        if await quartr_api.get_document(event.get('reportUrl'), session, sink=content):
+                            original_filename = event.get('reportUrl').split('/')[-1]
                                 
-                                filename = storage_handler.create_filename(
-                                    company_name, event_date, event_title, 'report', original_filename
-                                )
+                            # Remove any URL query parameters from the original filename
+                            if '?' in original_filename:
+                                original_filename = original_filename.split('?')[0]
                                 
-                                success = await storage_handler.upload_file(
-                                    content, filename, 'application/pdf'
-                                )
-                                
-                                if success:
-                                    public_url = storage_handler.get_public_url(filename)
-                                    processed_files.append({
-                                        'filename': filename,
-                                        'type': 'report',
-                                        'title': event_title,
-                                        'date': event_date,
-                                        'url': public_url
-                                    })
-                                    report_count += 1
-                                    logger.info(f"Successfully processed and stored report: {filename}")
-                            else:
-                                logger.error(f"Failed to download report: HTTP {response.status}")
-                    except Exception as e:
-                        logger.error(f"Error processing report for {event_title}: {str(e)}")
-                
-                # Process transcript (if we need more)
-                if transcript_count < 2 and event.get('transcriptUrl'):
-                    try:
-                        # Log the transcript URL we're processing
-                        logger.info(f"Processing transcript from: {event.get('transcriptUrl')}")
-                        
-                        # Get transcript data
-                        transcripts = event.get('transcripts', {})
-                        if not transcripts:
-                            # If the transcripts object is empty, check for liveTranscripts
-                            transcripts = event.get('liveTranscripts', {})
-                        
-                        transcript_text = await transcript_processor.process_transcript(
-                            event.get('transcriptUrl'), transcripts, session
-                        )
-                        
-                        if transcript_text:
-                            pdf_data = transcript_processor.create_pdf(
-                                company_name, event_title, event_date, transcript_text
-                            )
-                            
                             filename = storage_handler.create_filename(
-                                company_name, event_date, event_title, 'transcript', 'transcript.pdf'
+                                company_name, event_date, event_title, 'report', original_filename
                             )
-                            
-                            success = await storage_handler.upload_file(
-                                pdf_data, filename, 'application/pdf'
+                                
+                            content.seek(0)
+                            success = await storage_handler.upload_fileobj(
+                                content, filename, 'application/pdf'
                             )
-                            
+                                
                             if success:
                                 public_url = storage_handler.get_public_url(filename)
                                 processed_files.append({
                                     'filename': filename,
-                                    'type': 'transcript',
+                                    'type': 'report',
                                     'title': event_title,
                                     'date': event_date,
-                                    'url': public_url,
-                                    'text': transcript_text[:1000] + "..." if len(transcript_text) > 1000 else transcript_text
+                                    'url': public_url
                                 })
-                                transcript_count += 1
-                                logger.info(f"Successfully processed and stored transcript: {filename}")
-                    except Exception as e:
-                        logger.error(f"Error processing transcript for {event_title}: {str(e)}")
+                                report_count += 1
+                                logger.info(f"Successfully processed and stored report: {filename}")
+                        else:
+                            logger.error(f"Failed to download report")
+                except Exception as e:
+                    logger.error(f"Error processing report for {event_title}: {str(e)}")
+                
+            # Process transcript (if we need more)
+            if transcript_count < 2 and event.get('transcriptUrl'):
+                try:
+                    # Log the transcript URL we're processing
+                    logger.info(f"Processing transcript from: {event.get('transcriptUrl')}")
+                        
+                    # Get transcript data
+                    transcripts = event.get('transcripts', {})
+                    if not transcripts:
+                        # If the transcripts object is empty, check for liveTranscripts
+                        transcripts = event.get('liveTranscripts', {})
+                        
+                    transcript_text = await transcript_processor.process_transcript(
+                        event.get('transcriptUrl'), transcripts, session
+                    )
+                        
+                    if transcript_text:
+                        pdf_data = await transcript_processor.create_pdf_async(
+                            company_name, event_title, event_date, transcript_text
+                        )
+                            
+                        filename = storage_handler.create_filename(
+                            company_name, event_date, event_title, 'transcript', 'transcript.pdf'
+                        )
+                            
+                        success = await storage_handler.upload_file(
+                            pdf_data, filename, 'application/pdf'
+                        )
+                            
+                        if success:
+                            public_url = storage_handler.get_public_url(filename)
+                            processed_files.append({
+                                'filename': filename,
+                                'type': 'transcript',
+                                'title': event_title,
+                                'date': event_date,
+                                'url': public_url,
+                                'text': transcript_text[:1000] + "..." if len(transcript_text) > 1000 else transcript_text
+                            })
+                            transcript_count += 1
+                            logger.info(f"Successfully processed and stored transcript: {filename}")
+                except Exception as e:
+                    logger.error(f"Error processing transcript for {event_title}: {str(e)}")
             
-            # Log the number of documents processed
-            logger.info(f"Processed {pdf_count} presentations, {report_count} reports, and {transcript_count} transcripts")
-            return processed_files
+        # Log the number of documents processed
+        logger.info(f"Processed {pdf_count} presentations, {report_count} reports, and {transcript_count} transcripts")
+        return processed_files
     except Exception as e:
         logger.error(f"Error in process_company_documents: {str(e)}")
         return []
@@ -664,6 +676,28 @@ async def root():
         "message": "Welcome to the Financial Insights API!"
     }
 
+# Open the S3 connection at startup without delaying it, so the first upload skips the handshake
+@app.on_event("startup")
+async def warm_storage():
+    app.state.storage_warmup = asyncio.create_task(get_storage_handler().warmup())
+
+# Load the company index in a worker thread at startup, so the first Quartr ID lookup is served from memory
+@app.on_event("startup")
+async def warm_company_cache():
+    app.state.company_warmup = asyncio.get_running_loop().run_in_executor(None, warm_cache)
+
+# Close the pooled Quartr session and S3 client with the app
+@app.on_event("shutdown")
+async def close_http_sessions():
+    await QuartrAPI.close_sessions()
+    if get_storage_handler.cache_info().currsize:
+        await get_storage_handler().close()
+
+# Stop the PDF rendering workers with the app
+@app.on_event("shutdown")
+async def stop_pdf_workers():
+    shutdown_pdf_pool()
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
@@ -4,9 +4,13 @@ Uses the Supabase Python client for more reliable connections.
 """
 
 import os
+import sys
+import time
+import threading
 from supabase import create_client
-from typing import Dict, List, Optional
-import pandas as pd
+from supabase.lib.client_options import ClientOptions
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
 import logging
 from dotenv import load_dotenv
 from functools import lru_cache
@@ -16,11 +20,13 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Columns needed for name/ID lookups; wide rows are only fetched by callers that need them
+_MINIMAL_COLUMNS = 'Name,ISIN,"Quartr Id"'
+
 # Initialize Supabase client
-@lru_cache(maxsize=1)
 def init_client():
     """
-    Initialize and cache the Supabase client connection
+    Initialize the Supabase client connection (cached by _client)
     """
     try:
         # Use the hardcoded credentials as fallback
@@ -36,36 +42,148 @@ def init_client():
         if env_key:
             supabase_key = env_key
                 
-        # Initialize the client
-        client = create_client(supabase_url, supabase_key)
+        # Initialize the client once; its HTTP connection pool is kept alive across lookups,
+        # and the timeout stops a slow PostgREST call from stalling the caller indefinitely
+        client = create_client(
+            supabase_url, supabase_key,
+            options=ClientOptions(postgrest_client_timeout=10)
+        )
+        
+        # Fail fast on bad credentials (e.g. a revoked fallback key) so getters take their no-client path
+        # instead of each paying a round trip and a 401
+        try:
+            client.table('universe').select('Name').limit(1).execute()
+        except Exception as e:
+            logger.error(f"Supabase client failed its connectivity check: {str(e)}")
+            return None
+        
         return client
         
     except Exception as e:
         logger.error(f"Failed to initialize Supabase client: {str(e)}")
         return None
 
-@lru_cache(maxsize=100)
-def get_all_companies() -> List[Dict]:
+# Module-level handle to the Supabase client, set on first successful initialization
+_CLIENT = None
+_CLIENT_RETRY_AT = 0.0
+# The warm-up thread and request threads can reach initialization together; only one of them runs it
+_CLIENT_LOCK = threading.Lock()
+
+# Seconds to wait before retrying a failed initialization
+CLIENT_RETRY_INTERVAL = 60
+
+def _client():
+    """
+    Returns the shared Supabase client without a lock or cache lookup once initialized,
+    retrying initialization at most once per CLIENT_RETRY_INTERVAL if it failed before.
+    """
+    global _CLIENT, _CLIENT_RETRY_AT
+    if _CLIENT is None and time.monotonic() >= _CLIENT_RETRY_AT:
+        with _CLIENT_LOCK:
+            if _CLIENT is None and time.monotonic() >= _CLIENT_RETRY_AT:
+                _CLIENT = init_client()
+                if _CLIENT is None:
+                    _CLIENT_RETRY_AT = time.monotonic() + CLIENT_RETRY_INTERVAL
+    return _CLIENT
+
+def _require_client():
+    """
+    Returns the shared Supabase client, raising if it is unavailable.
+    
+    The lru_cached lookups below raise instead of returning an empty result,
+    since lru_cache does not memoize exceptions; a failure is then retried on the
+    next call rather than cached for the life of the process.
+    """
+    client = _client()
+    if not client:
+        raise RuntimeError("Supabase client not available")
+    return client
+
+# Identifier columns interned when rows are fetched
+_INTERNED_COLUMNS = frozenset({"Name", "ISIN"})
+
+@lru_cache(maxsize=2)
+def _fetch_universe(columns: str) -> Tuple[Dict, ...]:
+    """
+    Fetches the given columns of every row in the Supabase 'universe' table, raising on failure.
+    """
+    response = _require_client().table('universe').select(columns).execute()
+    # Intern the identifiers while building the rows, so both column sets and the indexes share one
+    # string object per identifier and nothing has to write into the cached rows afterwards
+    return tuple(
+        {
+            column: sys.intern(value) if column in _INTERNED_COLUMNS and isinstance(value, str) else value
+            for column, value in row.items()
+        }
+        for row in getattr(response, 'data', None) or ()
+    )
+
+def get_all_companies() -> Tuple[Dict, ...]:
     """
     Fetches all companies from the Supabase 'universe' table.
     
     Returns:
-        List[Dict]: A list of company data dictionaries
+        Tuple[Dict, ...]: The company data dictionaries (a tuple, so the cached result can't be mutated)
     """
     try:
-        client = init_client()
-        if not client:
-            return []
-            
-        response = client.table('universe').select('*').execute()
-        if hasattr(response, 'data'):
-            return response.data
-        return []
+        return _fetch_universe('*')
     except Exception as e:
         logger.error(f"Error fetching companies from Supabase: {str(e)}")
-        return []
+        return ()
+
+def get_company_identifiers() -> Tuple[Dict, ...]:
+    """
+    Fetches only the identifying columns of the Supabase 'universe' table.
+    
+    Returns:
+        Tuple[Dict, ...]: Dictionaries with Name, ISIN and Quartr Id
+    """
+    try:
+        return _fetch_universe(_MINIMAL_COLUMNS)
+    except Exception as e:
+        logger.error(f"Error fetching company identifiers from Supabase: {str(e)}")
+        return ()
+
+@lru_cache(maxsize=2)
+def _company_indexes(full: bool = False) -> Dict[str, Dict[str, Dict]]:
+    """
+    Builds in-process lookups over the cached 'universe' table, raising if it can't be fetched.
+    
+    Args:
+        full (bool): Index complete rows instead of just the identifying columns
+        
+    Returns:
+        dict: Companies keyed by Name ('by_name'), ISIN ('by_isin') and Quartr ID as string ('by_quartrid')
+    """
+    indexes = {"by_name": {}, "by_isin": {}, "by_quartrid": {}}
+    for company in _fetch_universe('*' if full else _MINIMAL_COLUMNS):
+        # Names and ISINs were interned by _fetch_universe; the cached rows are only read here
+        if company.get("Name"):
+            indexes["by_name"].setdefault(company["Name"], company)
+        if company.get("ISIN"):
+            indexes["by_isin"].setdefault(company["ISIN"], company)
+        if company.get("Quartr Id") is not None:
+            indexes["by_quartrid"].setdefault(sys.intern(str(company["Quartr Id"])), company)
+    return indexes
+
+# Returned by _indexes while the 'universe' table can't be fetched
+_NO_INDEXES = MappingProxyType({"by_name": {}, "by_isin": {}, "by_quartrid": {}})
+
+def _indexes(full: bool = False) -> Mapping[str, Dict[str, Dict]]:
+    """
+    Returns the cached lookups, or empty ones (not cached) if the table can't be fetched.
+    """
+    try:
+        return _company_indexes(full)
+    except Exception as e:
+        logger.error(f"Error indexing companies from Supabase: {str(e)}")
+        return _NO_INDEXES
+
+@lru_cache(maxsize=1)
+def _company_names() -> List[str]:
+    # The name index already holds each non-empty name once, in table order
+    return list(_company_indexes()["by_name"])
 
-@lru_cache(maxsize=100)
 def get_company_names() -> List[str]:
     """
     Returns a list of all company names from Supabase.
@@ -73,10 +191,47 @@ def get_company_names() -> List[str]:
     Returns:
         List[str]: A list of company names
     """
-    companies = get_all_companies()
-    return [company["Name"] for company in companies if "Name" in company]
+    try:
+        return _company_names()
+    except Exception as e:
+        logger.error(f"Error fetching company names from Supabase: {str(e)}")
+        return []
+
+# Returned by get_ids_by_name when a lookup fails
+_NO_IDS = MappingProxyType({"quartr_id": None, "isin": None})
+
+# Bounded above the universe size, so every listed company stays cached
+@lru_cache(maxsize=1024)
+def _lookup_ids(company_name: str) -> Mapping[str, Optional[str]]:
+    company = _indexes()["by_name"].get(company_name)
+    
+    if not company:
+        # One round trip for both columns instead of one query per identifier
+        response = _require_client().table('universe').select('ISIN,\"Quartr Id\"').eq('Name', company_name).limit(1).execute()
+        company = response.data[0] if response.data else {}
+    
+    quartr_id = company.get("Quartr Id")
+    return MappingProxyType({
+        "quartr_id": str(quartr_id) if quartr_id is not None else None,  # Convert to string to ensure compatibility
+        "isin": company.get("ISIN")
+    })
+
+def get_ids_by_name(company_name: str) -> Mapping[str, Optional[str]]:
+    """
+    Retrieves both identifiers for a given company name in a single lookup.
+    
+    Args:
+        company_name (str): The company name to look up
+        
+    Returns:
+        Mapping: Read-only 'quartr_id' (as string) and 'isin', each None if not found
+    """
+    try:
+        return _lookup_ids(company_name)
+    except Exception as e:
+        logger.error(f"Error fetching identifiers for {company_name}: {str(e)}")
+        return _NO_IDS
 
-@lru_cache(maxsize=100)
 def get_quartrid_by_name(company_name: str) -> Optional[str]:
     """
     Retrieves the Quartr ID for a given company name from Supabase.
@@ -87,23 +242,83 @@ def get_quartrid_by_name(company_name: str) -> Optional[str]:
     Returns:
         str: The Quartr ID if found, None otherwise
     """
+    quartr_id = get_ids_by_name(company_name)["quartr_id"]
+    if quartr_id:
+        logger.info(f"Found Quartr ID {quartr_id} for company: {company_name}")
+    return quartr_id
+
+def get_isin_by_name(company_name: str) -> Optional[str]:
+    """
+    Retrieves the ISIN for a given company name from Supabase.
+    
+    Args:
+        company_name (str): The company name to look up
+        
+    Returns:
+        str: The ISIN if found, None otherwise
+    """
+    return get_ids_by_name(company_name)["isin"]
+
+def get_quartrids_by_names(company_names: List[str]) -> Dict[str, str]:
+    """
+    Retrieves Quartr IDs for several company names with at most one Supabase query.
+    
+    Args:
+        company_names (List[str]): The company names to look up
+        
+    Returns:
+        dict: Quartr ID (as string) per company name, for the names that have one
+    """
+    by_name = _indexes()["by_name"]
+    quartr_ids = {}
+    missing = []
+    for name in dict.fromkeys(company_names):
+        company = by_name.get(name)
+        if company and company.get("Quartr Id") is not None:
+            quartr_ids[name] = str(company["Quartr Id"])
+        else:
+            missing.append(name)
+    
+    if not missing:
+        return quartr_ids
+    
     try:
-        client = init_client()
+        client = _client()
         if not client:
-            return None
+            return quartr_ids
             
-        response = client.table('universe').select('\"Quartr Id\"').eq('Name', company_name).execute()
-        if response.data and len(response.data) > 0:
-            quartr_id = response.data[0].get("Quartr Id")
-            logger.info(f"Found Quartr ID {quartr_id} for company: {company_name}")
-            return str(quartr_id)  # Convert to string to ensure compatibility
-        return None
+        # Names outside the cached index are fetched together rather than one request each
+        response = client.table('universe').select('Name,\"Quartr Id\"').in_('Name', missing).execute()
+        for company in response.data or []:
+            if company.get("Quartr Id") is not None:
+                quartr_ids[company["Name"]] = str(company["Quartr Id"])
     except Exception as e:
-        logger.error(f"Error fetching Quartr ID for {company_name}: {str(e)}")
-        return None
+        logger.error(f"Error fetching Quartr IDs for {len(missing)} companies: {str(e)}")
+    return quartr_ids
+
+@lru_cache(maxsize=1024)
+def _lookup_by_quartrid(quartrid: str) -> Optional[Mapping]:
+    company = _indexes(full=True)["by_quartrid"].get(quartrid)
+    if company:
+        return MappingProxyType(company)
+    
+    response = _require_client().table('universe').select('*').eq('\"Quartr Id\"', quartrid).limit(1).execute()
+    if response.data and len(response.data) > 0:
+        return MappingProxyType(response.data[0])
+    return None
 
-@lru_cache(maxsize=100)
-def get_company_by_quartrid(quartrid: str) -> Optional[Dict]:
+@lru_cache(maxsize=1024)
+def _lookup_by_isin(isin: str) -> Optional[Mapping]:
+    company = _indexes(full=True)["by_isin"].get(isin)
+    if company:
+        return MappingProxyType(company)
+    
+    response = _require_client().table('universe').select('*').eq('ISIN', isin).limit(1).execute()
+    if response.data and len(response.data) > 0:
+        return MappingProxyType(response.data[0])
+    return None
+
+def get_company_by_quartrid(quartrid: str) -> Optional[Mapping]:
     """
     Retrieves company data for a given Quartr ID from Supabase.
     
@@ -111,17 +326,39 @@ def get_company_by_quartrid(quartrid: str) -> Optional[Dict]:
         quartrid (str): The Quartr ID to look up
         
     Returns:
-        dict: The company data if found, None otherwise
+        Mapping: A read-only view of the company data if found, None otherwise
     """
     try:
-        client = init_client()
-        if not client:
-            return None
-            
-        response = client.table('universe').select('*').eq('\"Quartr Id\"', quartrid).execute()
-        if response.data and len(response.data) > 0:
-            return response.data[0]
-        return None
+        return _lookup_by_quartrid(str(quartrid))
     except Exception as e:
         logger.error(f"Error fetching company by Quartr ID {quartrid}: {str(e)}")
         return None
+
+def get_company_by_isin(isin: str) -> Optional[Mapping]:
+    """
+    Retrieves company data for a given ISIN from Supabase.
+    
+    Args:
+        isin (str): The ISIN to look up
+        
+    Returns:
+        Mapping: A read-only view of the company data if found, None otherwise
+    """
+    try:
+        return _lookup_by_isin(isin)
+    except Exception as e:
+        logger.error(f"Error fetching company by ISIN {isin}: {str(e)}")
+        return None
+
+def warm_cache() -> None:
+    """
+    Loads the company identifiers and lookup indexes so the first user lookup is served from memory.
+    
+    Blocking; meant to be called from an application's startup hook, off its event loop.
+    A failed warm-up caches nothing, so the first lookup simply fetches again.
+    """
+    try:
+        indexes = _company_indexes()
+        logger.info(f"Warmed company cache with {len(indexes['by_name'])} companies")
+    except Exception as e:
+        logger.error(f"Error warming company cache: {str(e)}")